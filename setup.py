@@ -1,11 +1,49 @@
 import os
-import json
-from google.cloud import secretmanager
-from elasticsearch import Elasticsearch, NotFoundError
-from typing import Any, Dict, List, Optional
+import re
+import asyncio
+import logging
+import functools
+import textwrap
+import orjson
+from elasticsearch import AsyncElasticsearch, NotFoundError
+from elasticsearch.serializer import OrjsonSerializer
+from typing import TYPE_CHECKING, Any, Dict, Optional, Sequence
 
+if TYPE_CHECKING:
+    from google.cloud import secretmanager
 
+
+logger = logging.getLogger(__name__)
+
+PAINLESS_TOKEN_PATTERN = re.compile(r"(\"(?:\\.|[^\"\\])*\"|'(?:\\.|[^'\\])*')|\s+")
+
+
+def compact_painless(source: str) -> str:
+    """Collapse whitespace outside string literals; sources must not use // comments"""
+    return PAINLESS_TOKEN_PATTERN.sub(
+        lambda match: match.group(1) or " ", source
+    ).strip()
+
+
+ENV = os.getenv("ENV", "dev")
+ELASTIC_SECRETS = {
+    "prod": "GEO_ELASTIC_PROD",
+    "staging": "GEO_ELASTIC_STAGING",
+    "dev": "GEO_ELASTIC_DEV",
+}
+if ENV not in ELASTIC_SECRETS:
+    raise ValueError(f"Unknown ENV '{ENV}', expected one of {list(ELASTIC_SECRETS)}")
+ELASTIC_SECRET_NAME = ELASTIC_SECRETS[ENV]
 EMBEDDING_MODEL_ID = "text-embedding-005"
+ES_CONNECTIONS_PER_NODE = 16
+NORMALIZER_PIPELINE_ID = "es-crawler-normalizer-pipeline"
+EMBEDDING_PIPELINE_ID = "es-crawler-embedding-pipeline"
+SELF_SERVED_PIPELINE_ID = "self-served-crawler-pipeline"
+# Bump a version whenever its pipeline body changes (for the normalizer, this
+# includes STORED_SCRIPTS) so existing clusters pick up the new definition.
+NORMALIZER_PIPELINE_VERSION = 1
+EMBEDDING_PIPELINE_VERSION = 1
+SELF_SERVED_PIPELINE_VERSION = 1
 JOIN_HEADERS_PROCESSOR = {
     "join": {
         "field": "headings",
@@ -16,17 +54,62 @@ JOIN_HEADERS_PROCESSOR = {
 SET_BODY_PROCESSOR = {
     "set": {
         "field": "text",
-        "value": """
-      Meta Description: {{{meta_description}}}
-      Headings: {{{headings}}}
-      Body: {{{body}}} {{{body_content}}}
-    """,
+        "value": textwrap.dedent(
+            """
+            Meta Description: {{{meta_description}}}
+            Headings: {{{headings}}}
+            Body: {{{body}}} {{{body_content}}}
+            """
+        ).strip(),
     }
 }
-REMOVE_FIELDS_PROCESSOR = {
+SPLIT_URL_PROCESSOR = {
+    "uri_parts": {
+        "field": "url",
+        "target_field": "temp_url_parts",
+        "keep_original": True,
+        "ignore_failure": True,
+    }
+}
+SET_DATES_SCRIPT_ID = "es-crawler-set-dates"
+SET_DATES_SCRIPT = compact_painless(
+    """
+    if (ctx.containsKey("last_crawled_at") && ctx.last_crawled_at != null) {
+        ctx.date = ctx.last_crawled_at;
+    } else {
+        ctx.date = (new Date()).getTime();
+        ctx.last_crawled_at = ctx.date;
+    }
+    """
+)
+SET_DATES_PROCESSOR = {
     "script": {
-        "source": """
-          String[] fieldsToRemove = new String[] {
+        "id": SET_DATES_SCRIPT_ID,
+        "description": "Sets the date field based on last_crawled_at or current time",
+    }
+}
+NORMALIZED_URL_PROCESSOR = {
+    "set": {
+        "field": "normalized_url",
+        "value": (
+            "{{{temp_url_parts.scheme}}}://{{{temp_url_parts.domain}}}"
+            "{{#temp_url_parts.port}}:{{{temp_url_parts.port}}}{{/temp_url_parts.port}}"
+            "{{{temp_url_parts.path}}}"
+        ),
+        "if": "ctx.temp_url_parts != null",
+    }
+}
+STRIP_TRAILING_SLASH_PROCESSOR = {
+    "gsub": {
+        "field": "normalized_url",
+        "pattern": "/$",
+        "replacement": "",
+        "ignore_missing": True,
+    }
+}
+REMOVE_FIELDS_PROCESSOR = {
+    "remove": {
+        "field": [
             "body",
             "body_content",
             "meta_description",
@@ -40,64 +123,9 @@ REMOVE_FIELDS_PROCESSOR = {
             "url_path_dir3",
             "additional_urls",
             "domains",
-            "url_scheme"
-          };
-          for (field in fieldsToRemove) {
-              if (ctx.containsKey(field)) {
-                  ctx.remove(field);
-              }
-          }
-        """,
-        "description": "Runs a script to remove unnecessary fields",
-    }
-}
-SET_DATES_PROCESSOR = {
-    "script": {
-        "source": """
-        if (ctx.containsKey("last_crawled_at") && ctx.last_crawled_at != null) {
-            ctx.date = ctx.last_crawled_at;
-        } else {
-            ctx.date = (new Date()).getTime();
-            ctx.last_crawled_at = ctx.date;
-        }
-        """,
-        "description": "Sets the date field based on last_crawled_at or current time",
-    }
-}
-SPLIT_URL_PROCESSOR = {
-    "uri_parts": {
-        "field": "url",
-        "target_field": "temp_url_parts",
-        "keep_original": True,
-        "ignore_failure": True,
-    }
-}
-NORMALIZED_URL_PROCESSOR = {
-    "script": {
-        "if": "ctx.containsKey('temp_url_parts')",
-        "source": """
-    def parts = ctx.temp_url_parts;
-    String path = parts.path;
-    
-    // 1. Handle the path (remove trailing slash)
-    if (path != null && path.endsWith('/') && path.length() > 0) {
-      path = path.substring(0, path.length() - 1);
-    } else if (path == null) {
-      path = "";
-    }
-    
-    // 2. Rebuild the normalized URL
-    String normalized = parts.scheme + "://" + parts.domain;
-    
-    // 3. Add port only if it exists
-    if (parts.port != null) {
-      normalized += ":" + parts.port;
-    }
-    
-    // 4. Add the cleaned path
-    normalized += path;
-    ctx.normalized_url = normalized;
-  """,
+            "url_scheme",
+        ],
+        "ignore_missing": True,
     }
 }
 REMOVE_TEMP_URL_PARTS_PROCESSOR = {
@@ -115,77 +143,171 @@ VERTEXAI_EMBEDDINGS_PROCESSOR = {
         },
     }
 }
+NORMALIZER_PROCESSORS = (
+    JOIN_HEADERS_PROCESSOR,
+    SET_BODY_PROCESSOR,
+    SPLIT_URL_PROCESSOR,
+    SET_DATES_PROCESSOR,
+    NORMALIZED_URL_PROCESSOR,
+    STRIP_TRAILING_SLASH_PROCESSOR,
+    REMOVE_FIELDS_PROCESSOR,
+    REMOVE_TEMP_URL_PARTS_PROCESSOR,
+)
+EMBEDDING_PROCESSORS = (VERTEXAI_EMBEDDINGS_PROCESSOR,)
+STORED_SCRIPTS = {SET_DATES_SCRIPT_ID: SET_DATES_SCRIPT}
+SELF_SERVED_PROCESSORS = (
+    {"pipeline": {"name": "search-default-ingestion"}},
+    {"pipeline": {"name": NORMALIZER_PIPELINE_ID}},
+    {"pipeline": {"name": EMBEDDING_PIPELINE_ID}},
+)
+
 
+@functools.lru_cache(maxsize=1)
+def get_secret_manager_client() -> "secretmanager.SecretManagerServiceClient":
+    """Build the Secret Manager client once; its channel and credentials are reused"""
+    # Imported lazily: the gRPC/protobuf stack is slow to load and only
+    # needed once a secret is actually requested.
+    from google.cloud import secretmanager
 
+    return secretmanager.SecretManagerServiceClient()
+
+
+@functools.lru_cache(maxsize=None)
 def fetch_gcp_secret(secret_name: str) -> str:
-    """Fetch secret from Google Secret Manager"""
+    """Fetch secret from Google Secret Manager, cached per secret name"""
     SECRET_MANAGER_PROJECT_ID = "rag-query-analytics"
-    client = secretmanager.SecretManagerServiceClient()
+    client = get_secret_manager_client()
     secret_version = client.secret_version_path(
         SECRET_MANAGER_PROJECT_ID, secret_name, "latest"
     )
     response = client.access_secret_version(name=secret_version)
-    secret_value = response.payload.data.decode("UTF-8")
+    secret_data = response.payload.data
     try:
-        _ = json.loads(secret_value)
-    except json.JSONDecodeError:
+        _ = orjson.loads(secret_data)
+    except orjson.JSONDecodeError:
         raise Exception("Secret is not a valid JSON string")
-    return secret_value
-
-
-def get_es_client() -> Elasticsearch:
-    ENV = os.getenv("ENV", "dev")
-    ELASTIC_SECRET = {
-        "prod": "GEO_ELASTIC_PROD",
-        "staging": "GEO_ELASTIC_STAGING",
-        "dev": "GEO_ELASTIC_DEV",
-    }[ENV]
-    elastic_secret_json = fetch_gcp_secret(ELASTIC_SECRET)
-    elastic_secret_dict = json.loads(elastic_secret_json)
+    return secret_data.decode("UTF-8")
+
+
+async def fetch_gcp_secret_async(secret_name: str) -> str:
+    """Fetch secret off the event loop, the Secret Manager client is blocking"""
+    return await asyncio.to_thread(fetch_gcp_secret, secret_name)
+
+
+async def get_es_client() -> AsyncElasticsearch:
+    """Build the Elasticsearch client shared by the whole setup flow"""
+    elastic_secret_json = await fetch_gcp_secret_async(ELASTIC_SECRET_NAME)
+    elastic_secret_dict = orjson.loads(elastic_secret_json)
     host = elastic_secret_dict["host"]
     api_key = elastic_secret_dict["api_key"]
-    es_client = Elasticsearch(hosts=host, api_key=api_key)
-    assert es_client.ping(), "Elasticsearch cluster is not reachable"
+    es_client = AsyncElasticsearch(
+        hosts=host,
+        api_key=api_key,
+        http_compress=True,
+        connections_per_node=ES_CONNECTIONS_PER_NODE,
+        serializer=OrjsonSerializer(),
+    )
+    if not await es_client.ping():
+        await es_client.close()
+        raise Exception("Elasticsearch cluster is not reachable")
     return es_client
 
 
-def setup_ingest_pipeline(
-    es_client: Elasticsearch,
+async def fetch_existing_pipelines(
+    es_client: AsyncElasticsearch, pipeline_ids: Sequence[str]
+) -> Dict[str, Optional[int]]:
+    """Map each existing pipeline id to its version, None if it has none"""
+    try:
+        response = await es_client.ingest.get_pipeline(id=",".join(pipeline_ids))
+    except NotFoundError:
+        # Only raised when none of the requested pipelines exist.
+        return {}
+    return {
+        pipeline_id: pipeline.get("version")
+        for pipeline_id, pipeline in response.body.items()
+    }
+
+
+async def put_pipeline(
+    es_client: AsyncElasticsearch,
     pipeline_id: str,
     description: str,
-    processors: List[Dict[str, Any]],
+    processors: Sequence[Dict[str, Any]],
+    version: int,
 ) -> Optional[str]:
     try:
-        es_client.ingest.get_pipeline(id=pipeline_id)
-        print(f"Ingest pipeline '{pipeline_id}' already exists.")
+        await es_client.ingest.put_pipeline(
+            id=pipeline_id,
+            description=description,
+            processors=processors,
+            version=version,
+        )
+        logger.info(
+            "Ingest pipeline '%s' has been set up at version %s.", pipeline_id, version
+        )
         return pipeline_id
-    except NotFoundError:
-        try:
-            es_client.ingest.put_pipeline(
-                id=pipeline_id, description=description, processors=processors
-            )
-            print(f"Ingest pipeline '{pipeline_id}' has been created.")
-            return pipeline_id
-        except Exception as e:
-            print(f"Error creating ingest pipeline '{pipeline_id}': {e}")
-            return None
+    except Exception as e:
+        logger.error("Error creating ingest pipeline '%s': %s", pipeline_id, e)
+        return None
 
 
-def create_vertexai_embedding_inference_endpoint(
-    es_client: Elasticsearch, inference_id: str
+async def setup_stored_script(
+    es_client: AsyncElasticsearch, script_id: str, source: str
+) -> Optional[str]:
+    try:
+        await es_client.put_script(
+            id=script_id, script={"lang": "painless", "source": source}
+        )
+        logger.info("Stored script '%s' has been created.", script_id)
+        return script_id
+    except Exception as e:
+        logger.error("Error creating stored script '%s': %s", script_id, e)
+        return None
+
+
+async def setup_stored_scripts(es_client: AsyncElasticsearch) -> bool:
+    script_ids = await asyncio.gather(
+        *(
+            setup_stored_script(es_client, script_id, source)
+            for script_id, source in STORED_SCRIPTS.items()
+        )
+    )
+    return all(script_ids)
+
+
+async def setup_ingest_pipeline(
+    es_client: AsyncElasticsearch,
+    pipeline_id: str,
+    description: str,
+    processors: Sequence[Dict[str, Any]],
+    version: int,
+    existing: Dict[str, Optional[int]],
+) -> Optional[str]:
+    if existing.get(pipeline_id) == version:
+        logger.info(
+            "Ingest pipeline '%s' is already at version %s.", pipeline_id, version
+        )
+        return pipeline_id
+    return await put_pipeline(es_client, pipeline_id, description, processors, version)
+
+
+async def create_vertexai_embedding_inference_endpoint(
+    es_client: AsyncElasticsearch, inference_id: str
 ) -> Optional[str]:
     TASK_TYPE = "text_embedding"
     SERVICE_ACCOUNT_PROJECT_ID = "snippets-api-434014"
     SERVICE_ACCOUNT_LOCATION = "us-central1"
     SECRET_NAME = "snippets-api-project-service-account-json"
-    SERVICE_ACCOUNT_JSON = fetch_gcp_secret(SECRET_NAME)
+    # Unlike pipelines, PUT on an existing inference endpoint is rejected,
+    # so the existence check is still needed here.
     try:
-        es_client.inference.get(task_type=TASK_TYPE, inference_id=inference_id)
-        print(f"Inference endpoint '{inference_id}' already exists.")
+        await es_client.inference.get(task_type=TASK_TYPE, inference_id=inference_id)
+        logger.info("Inference endpoint '%s' already exists.", inference_id)
         return inference_id
     except NotFoundError:
         try:
-            es_client.inference.put_googlevertexai(
+            SERVICE_ACCOUNT_JSON = await fetch_gcp_secret_async(SECRET_NAME)
+            await es_client.inference.put_googlevertexai(
                 googlevertexai_inference_id=inference_id,
                 task_type="text_embedding",
                 service="googlevertexai",
@@ -196,76 +318,104 @@ def create_vertexai_embedding_inference_endpoint(
                     "project_id": SERVICE_ACCOUNT_PROJECT_ID,
                 },
             )
-            print(f"Inference endpoint '{inference_id}' has been created.")
+            logger.info("Inference endpoint '%s' has been created.", inference_id)
             return inference_id
         except Exception as e:
-            print(f"Error creating inference endpoint '{inference_id}': {e}")
+            logger.error("Error creating inference endpoint '%s': %s", inference_id, e)
             return None
 
 
-def create_normalizer_pipeline(es_client: Elasticsearch) -> bool:
-    pipeline_id = "es-crawler-normalizer-pipeline"
+async def create_normalizer_pipeline(
+    es_client: AsyncElasticsearch, existing: Dict[str, Optional[int]]
+) -> Optional[str]:
+    pipeline_id = NORMALIZER_PIPELINE_ID
     description = "Pipeline to normalize crawled data"
-    processors = [
-        JOIN_HEADERS_PROCESSOR,
-        SET_BODY_PROCESSOR,
-        REMOVE_FIELDS_PROCESSOR,
-        SET_DATES_PROCESSOR,
-        SPLIT_URL_PROCESSOR,
-        NORMALIZED_URL_PROCESSOR,
-        REMOVE_TEMP_URL_PARTS_PROCESSOR,
-    ]
-    return setup_ingest_pipeline(es_client, pipeline_id, description, processors)
-
-
-def create_embedding_pipeline(es_client: Elasticsearch) -> bool:
-    pipeline_id = "es-crawler-embedding-pipeline"
+    processors = NORMALIZER_PROCESSORS
+    version = NORMALIZER_PIPELINE_VERSION
+    # The pipeline references its Painless scripts by id, so they have to be
+    # stored before it is (re)created; this overlaps with the embedding setup.
+    if existing.get(pipeline_id) != version and not await setup_stored_scripts(
+        es_client
+    ):
+        logger.error("Failed to create normalizer stored scripts.")
+        return None
+    return await setup_ingest_pipeline(
+        es_client, pipeline_id, description, processors, version, existing
+    )
+
+
+async def create_embedding_pipeline(
+    es_client: AsyncElasticsearch, existing: Dict[str, Optional[int]]
+) -> Optional[str]:
+    pipeline_id = EMBEDDING_PIPELINE_ID
     description = "Pipeline to generate embeddings for crawled data"
-    processors = [VERTEXAI_EMBEDDINGS_PROCESSOR]
+    processors = EMBEDDING_PROCESSORS
     inference_id = VERTEXAI_EMBEDDINGS_PROCESSOR["inference"]["model_id"]
-    create_vertexai_embedding_inference_endpoint(es_client, inference_id)
-    return setup_ingest_pipeline(es_client, pipeline_id, description, processors)
+    await create_vertexai_embedding_inference_endpoint(es_client, inference_id)
+    return await setup_ingest_pipeline(
+        es_client,
+        pipeline_id,
+        description,
+        processors,
+        EMBEDDING_PIPELINE_VERSION,
+        existing,
+    )
+
 
+async def create_self_served_crawler_pipelines(es_client: AsyncElasticsearch) -> bool:
+    # Probe all pipeline versions with one request, then set up the normalizer
+    # and embedding pipelines concurrently; only the wrapper needs both IDs.
+    existing = await fetch_existing_pipelines(
+        es_client,
+        [NORMALIZER_PIPELINE_ID, EMBEDDING_PIPELINE_ID, SELF_SERVED_PIPELINE_ID],
+    )
+    normalizer_pipeline_id, embedding_pipeline_id = await asyncio.gather(
+        create_normalizer_pipeline(es_client, existing),
+        create_embedding_pipeline(es_client, existing),
+    )
 
-def create_self_served_crawler_pipelines(es_client: Elasticsearch) -> bool:
-    normalizer_pipeline_id = create_normalizer_pipeline(es_client)
     if not normalizer_pipeline_id:
-        print("Failed to create normalizer pipeline.")
+        logger.error("Failed to create normalizer pipeline.")
         return False
 
-    embedding_pipeline_id = create_embedding_pipeline(es_client)
     if not embedding_pipeline_id:
-        print("Failed to create embedding pipeline.")
+        logger.error("Failed to create embedding pipeline.")
         return False
 
-    self_served_pipeline_id = setup_ingest_pipeline(
+    self_served_pipeline_id = await setup_ingest_pipeline(
         es_client,
-        pipeline_id="self-served-crawler-pipeline",
+        pipeline_id=SELF_SERVED_PIPELINE_ID,
         description="Pipeline for self-served crawler to normalize and generate embeddings",
-        processors=[
-            {"pipeline": {"name": "search-default-ingestion"}},
-            {"pipeline": {"name": normalizer_pipeline_id}},
-            {"pipeline": {"name": embedding_pipeline_id}},
-        ],
+        processors=SELF_SERVED_PROCESSORS,
+        version=SELF_SERVED_PIPELINE_VERSION,
+        existing=existing,
     )
     if not self_served_pipeline_id:
-        print("Failed to create self-served crawler pipeline.")
+        logger.error("Failed to create self-served crawler pipeline.")
         return False
     return True
 
 
-if __name__ == "__main__":
+async def main() -> bool:
     try:
-        print("Setting up self-served crawler pipelines...")
-        es_client = get_es_client()
-        success = create_self_served_crawler_pipelines(es_client)
+        logger.info("Setting up self-served crawler pipelines...")
+        # Built once and passed down, so every call reuses its connection pool.
+        async with await get_es_client() as es_client:
+            return await create_self_served_crawler_pipelines(es_client)
     except Exception as e:
-        print(f"An error occurred: {e}")
-        success = False
+        logger.error("An error occurred: %s", e)
+        return False
+
+
+if __name__ == "__main__":
+    # Only this module logs at INFO; the root logger stays at WARNING so the
+    # Elasticsearch transport does not log every request.
+    logging.basicConfig(format="%(levelname)s %(message)s")
+    logger.setLevel(logging.INFO)
+    success = asyncio.run(main())
+    if success:
+        logger.info("Self-served crawler pipelines have been set up successfully.")
+        exit(0)
     else:
-        if success:
-            print("Self-served crawler pipelines have been set up successfully.")
-            exit(0)
-        else:
-            print("Failed to set up self-served crawler pipelines.")
-            exit(1)
+        logger.error("Failed to set up self-served crawler pipelines.")
+        exit(1)